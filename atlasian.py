@@ -1,17 +1,34 @@
+import asyncio
+import os
+import ssl
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 from pathlib import Path
 import json
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import re
+import functools
+from contextlib import contextmanager
 from datetime import date, timedelta, datetime
-import time
-from typing import List
+from typing import List, Optional, Tuple
+from collections import defaultdict
 
+_TESTFILE_RE = re.compile(
+    r"^NTG7_Module_Test_(Star_\d+)?_?(rsu|hu|codd)_(([A-Z]\d+\.\d+)_(\d{4}-\d{2}-\d{2})_(v\d+\.\d+\.\d+\.?\d?))\.xlsx$",
+    re.IGNORECASE
+)
 
+
+@functools.lru_cache(maxsize=1024)
 def parse_testfile_name(file_name: str) -> dict:
     """
     General function for parsing test results file name
+    Results are cached, returned dict is shared between calls and must not be modified
     File name examples:
     "NTG7_Module_Test_RSU_E444.303_2023-03-29_v700.208.1.xlsx"
     "NTG7_Module_Test_Star_2_codd_E444.303_2023-03-29_v700.208.1.xlsx"
@@ -25,24 +42,7 @@ def parse_testfile_name(file_name: str) -> dict:
         "version": like v700.208.1
     }
     """
-    pattern_star = "(Star_\d+)?_?"
-    pattern_module = "(rsu|hu|codd)"
-    pattern_release = "([A-Z]\d+\.\d+)"
-    pattern_date = "(\d{4}-\d{2}-\d{2})"
-    pattern_version = "(v\d+\.\d+\.\d+\.?\d?)"
-    pattern_full_release = f"({pattern_release}_{pattern_date}_{pattern_version})"
-    pattern = "^NTG7_Module_Test_" + \
-        pattern_star + \
-        f"{pattern_module}_" + \
-        pattern_full_release + \
-        ".xlsx$"
-
-    """
-    Pattern is:
-    "^NTG7_Module_Test_(Star_\d+)?_?(rsu|hu|codd)_(([A-Z]\d+\.\d+)_(\d{4}-\d{2}-\d{2})_(v\d+\.\d+\.\d+\.?\d?)).xlsx$"
-    """
-    pattern = re.compile(pattern, re.IGNORECASE)
-    search = re.search(pattern, file_name)
+    search = _TESTFILE_RE.match(file_name)
     if not search:
         return None
     result = {
@@ -77,24 +77,62 @@ class Request:
         self.login = login
         self.auth = HTTPBasicAuth(self.login, self.token)
         self.cert = cert
+        self.session = self._prepare_session()
+
+    def _prepare_session(self, retry: bool = True) -> requests.Session:
+        """
+        Prepare persistent session with credentials, certificate and connection pool,
+        so repeated requests to the same host reuse connections
+        :param retry: retry failed requests with exponential backoff
+        :return: requests.Session
+        """
+        session = requests.Session()
+        session.auth = self.auth
+        session.cert = self.cert
+        max_retries = Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET", "POST", "DELETE", "PUT"],
+            respect_retry_after_header=True,
+            raise_on_status=False
+        ) if retry else Retry(total=0, raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=max_retries
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self) -> None:
+        "Close session and release pooled connections"
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
 
     def _get_request(self, endpoint: str = None, full_url: str = None,
-                     headers: dict = None, params: dict = None) -> requests.Response:
+                     headers: dict = None, params: dict = None, stream: bool = False) -> requests.Response:
         """
         Perform get request. If full_url is provided, it will be used instead of endpoint value
         :param endpoint: API endpoint path
         :param full_url: full API url
         :param headers: headers
         :param params: params
+        :param stream: do not load response body until it is consumed
         :return: requests.Response
         """
         url = full_url if full_url else f"{self.base_url}/{endpoint}"
-        response = requests.get(
+        response = self.session.get(
             url=url,
-            auth=self.auth,
-            cert=self.cert,
             headers=headers,
-            params=params
+            params=params,
+            stream=stream
         )
         if response.status_code not in [200, 204]:
             print(f"Unsuccessfull request to \n {url}")
@@ -102,21 +140,22 @@ class Request:
         return response
 
     def _post_request(self, endpoint: str = None, full_url: str = None,
-                      headers: dict = None, data: dict = None, files=None) -> requests.Response:
+                      headers: dict = None, data=None, files=None,
+                      session: requests.Session = None) -> requests.Response:
         """
         Perform post request. If full_url is provided, it will be used instead of endpoint value
         :param endpoint: API endpoint path
         :param full_url: full API url
         :param headers: headers
-        :param data: request body
+        :param data: request body - dict, string or stream (e.g. MultipartEncoder), passed as is
         :files: file as binary - open(file, 'rb')
+        :param session: session to send request with, instance session by default
         :return: requests.Response
         """
         url = full_url if full_url else f"{self.base_url}/{endpoint}"
-        response = requests.post(
+        session = session if session else self.session
+        response = session.post(
             url=url,
-            auth=self.auth,
-            cert=self.cert,
             headers=headers,
             data=data,
             files=files
@@ -136,10 +175,8 @@ class Request:
         :return: requests.Response
         """
         url = full_url if full_url else f"{self.base_url}/{endpoint}"
-        response = requests.delete(
+        response = self.session.delete(
             url=url,
-            auth=self.auth,
-            cert=self.cert,
             headers=headers,
             params=params
         )
@@ -175,24 +212,36 @@ class Jira(Request):
         download_folder.mkdir(exist_ok=True, parents=True)
         return download_folder
 
-    def search_issues(self, jql: str) -> List[dict]:
+    def search_issues(self, jql: str, start_at: int = 0, max_results: int = 100) -> List[dict]:
         """
-        Search jira issues with provided jql
+        Search jira issues with provided jql, all result pages are requested
         :param jql: jira query language string
+        :param start_at: index of the first issue to return
+        :param max_results: page size
         :return: dicit with jira issues from response
         """
         headers = {
             "Content-Type": "application/json"
         }
-        data = json.dumps({
-            "jql": f"{jql}",
-            "fields": [
-                "summary",
-                "attachment"
-            ]
-        })
-        response = self._post_request(endpoint="search", data=data, headers=headers)
-        return response.json().get("issues")
+        issues = []
+        while True:
+            data = json.dumps({
+                "jql": f"{jql}",
+                "fields": [
+                    "summary",
+                    "attachment"
+                ],
+                "startAt": start_at,
+                "maxResults": max_results
+            })
+            response = self._post_request(endpoint="search", data=data, headers=headers)
+            page = response.json()
+            page_issues = page.get("issues")
+            issues.extend(page_issues)
+            if not page_issues or start_at + len(page_issues) >= page.get("total"):
+                break
+            start_at += len(page_issues)
+        return issues
 
     def get_recently_updated_release_tasks(self, days_before: int = 3) -> List[dict]:
         """
@@ -207,30 +256,123 @@ class Jira(Request):
         ]
         """
         updatedDate = date.today() - timedelta(days=days_before)
-        jql = f'''
-        project = UISWTOOLS
-        AND summary ~ "\\\[NTG7\\\] Release build"
-        AND type = issue
-        AND component in ("ntg7-release-build")
-        AND updatedDate >= {updatedDate.strftime("%Y-%m-%d")}
-        ORDER BY created DESC
-        '''.replace("\n", " ")
-        jql = re.sub("\s+", " ", jql)
+        jql = (
+            'project = UISWTOOLS AND summary ~ "\\\\[NTG7\\\\] Release build" AND type = issue '
+            f'AND component in ("ntg7-release-build") AND updatedDate >= {updatedDate:%Y-%m-%d} ORDER BY created DESC'
+        )
 
         issues = [self.parse_issue(issue) for issue in self.search_issues(jql)]
         return issues
 
-    def download_attachment(self, content_url: str, output_name: str) -> None:
+    def _get_download_paths(self, output_name: str) -> Tuple[Path, Path]:
+        """
+        Get paths for downloaded file. Body is written into temporary ".part" file
+        which replaces output file only when download is complete
+        :param output_name: name for saved file
+        :return: (output path, temporary ".part" path)
+        """
+        output_path = self.download_path / output_name
+        return output_path, output_path.with_suffix(output_path.suffix + ".part")
+
+    def _commit_download_file(self, file, part_path: Path, output_path: Path) -> None:
+        """
+        Sync completely written ".part" file to disk, close it and move it to output path
+        :param file: ".part" file opened for binary write
+        :param part_path: temporary ".part" path
+        :param output_path: output path
+        :return: None
+        """
+        with file:
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(part_path, output_path)
+
+    def _discard_download_file(self, file, part_path: Path) -> None:
+        """
+        Close and remove ".part" file of failed download
+        :param file: ".part" file opened for binary write
+        :param part_path: temporary ".part" path
+        :return: None
+        """
+        file.close()
+        part_path.unlink(missing_ok=True)
+
+    @contextmanager
+    def _open_download_file(self, output_name: str):
+        """
+        Open ".part" file for download, it replaces output file on successful exit
+        and is removed on error
+        :param output_name: name for saved file
+        :return: file opened for binary write
+        """
+        output_path, part_path = self._get_download_paths(output_name)
+        file = open(part_path, "wb")
+        try:
+            yield file
+        except BaseException:
+            self._discard_download_file(file, part_path)
+            raise
+        self._commit_download_file(file, part_path, output_path)
+
+    def download_attachment(self, content_url: str, output_name: str) -> bool:
         """
         Download attachment by url and save into downloads folder with provided name
         :param content_url: attachment url for download
         :param output_name: name for saved file
-        :return: None
+        :return: True if file was downloaded else False
         """
-        response = self._get_request(full_url=content_url)
-        output_path = self.download_path / output_name
-        with open(output_path, "wb+") as file:
-            file.write(response.content)
+        with self._get_request(full_url=content_url, stream=True) as response:
+            if response.status_code != 200:
+                return False
+            with self._open_download_file(output_name) as file:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    file.write(chunk)
+        return True
+
+    async def _download_all(self, jobs: List[dict]) -> List[dict]:
+        """
+        Download attachments concurrently and save into downloads folder.
+        Proxy and CA bundle are taken from environment same way as in requests
+        :param jobs: [{file_name, download_url}] as returned by parse_attachments, file names must be unique
+        :return: jobs which were successfully downloaded
+        """
+        ssl_context = ssl.create_default_context(
+            cafile=os.environ.get("REQUESTS_CA_BUNDLE") or DEFAULT_CA_BUNDLE_PATH
+        )
+        ssl_context.load_cert_chain(*self.cert)
+        connector = aiohttp.TCPConnector(limit=10, ssl=ssl_context)
+        auth = aiohttp.BasicAuth(self.login, self.token)
+        semaphore = asyncio.Semaphore(8)
+        loop = asyncio.get_running_loop()
+
+        async def download(session: aiohttp.ClientSession, job: dict) -> bool:
+            async with semaphore, session.get(job["download_url"], auth=auth) as response:
+                if response.status != 200:
+                    print(f"Unsuccessfull request to \n {job['download_url']}")
+                    print(f"Response: \n {await response.text()}")
+                    return False
+                # File operations are offloaded to executor to not block other downloads
+                output_path, part_path = self._get_download_paths(job["file_name"])
+                file = await loop.run_in_executor(None, open, part_path, "wb")
+                try:
+                    async for chunk in response.content.iter_chunked(1 << 16):
+                        await loop.run_in_executor(None, file.write, chunk)
+                    await loop.run_in_executor(None, self._commit_download_file, file, part_path, output_path)
+                except BaseException:
+                    self._discard_download_file(file, part_path)
+                    raise
+            return True
+
+        async with aiohttp.ClientSession(connector=connector, trust_env=True) as session:
+            results = await asyncio.gather(*(download(session, job) for job in jobs), return_exceptions=True)
+
+        downloaded = []
+        for job, result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                print(f"Failed to download {job['file_name']}: {result!r}")
+            elif result:
+                downloaded.append(job)
+        return downloaded
 
     def parse_issue(self, issue: dict) -> dict:
         """
@@ -293,9 +435,50 @@ class Confluence(Request):
         """
         super().__init__(api_url, login, token, cert)
         self.page_id = page_id
+        # Streamed upload body can't be replayed, so attachment upload uses session without retries
+        self.upload_session = self._prepare_session(retry=False)
         self.current_labels = self.get_current_labels()
         self.attachments = self.get_attachments()
-        self.attachment_titles = [attachment.get("title") for attachment in self.attachments]
+        self._by_id = {}
+        self._by_title = {}
+        self._attachments_by_label = defaultdict(dict)
+        for attachment in self.attachments:
+            self._index_attachment(attachment, self.parse_attachment_labels(attachment))
+
+    def close(self) -> None:
+        "Close sessions and release pooled connections"
+        super().close()
+        self.upload_session.close()
+
+    def _index_attachment(self, attachment: dict, labels: List[str]) -> None:
+        """
+        Add attachment to lookup indices by id, title and labels
+        :param attachment: attachment dict
+        :param labels: attachment label names
+        :return: None
+        """
+        attachment_id = attachment["id"]
+        self._by_id[attachment_id] = attachment
+        self._by_title[attachment["title"]] = attachment
+        self._update_attachment_labels(attachment_id, added=labels)
+
+    def _update_attachment_labels(self, attachment_id: str, added: List[str] = (), removed: List[str] = ()) -> None:
+        """
+        Keep label indices in sync after labels were changed in confluence
+        :param attachment_id: ID of attachment
+        :param added: label names which were added
+        :param removed: label names which were removed
+        :return: None
+        """
+        if attachment_id not in self._by_id:
+            return None
+        attachment = self._by_id[attachment_id]
+        for label in added:
+            self._attachments_by_label[label][attachment_id] = attachment
+        for label in removed:
+            self._attachments_by_label[label].pop(attachment_id, None)
+        # Drop cached "latest" attachments, it will be rebuilt on next access
+        self.__dict__.pop("_latest_labeled_attachments", None)
 
     def get_page_meta(self) -> str:
         """
@@ -315,27 +498,27 @@ class Confluence(Request):
 
     def get_current_labels(self) -> List[str]:
         """
-        Look for <p> blocks in page html with following pattern ".*\s\(current\):$" to collect currently used labes
+        Look for <p> blocks in page html ending with " (current):" to collect currently used labes
         <p>Star2 FUP4 (current):</p> will result -> star2_fup4
         :return: list of labels
         """
-        page_body = BeautifulSoup(self.get_page_content(), "html.parser")
-        tag_strings = [span.string for span in page_body.find_all('p', string=re.compile(".*\s\(current\):$"))]
-        pattern = re.compile("^(.*) \(current\).*$")
-        labels = [re.search(pattern, value)[1].lower().replace("-", "_").replace(" ", "_") for value in tag_strings]
+        suffix = " (current):"
+        page_body = BeautifulSoup(self.get_page_content(), "lxml", parse_only=SoupStrainer('p'))
+        tag_strings = [p.string for p in page_body.find_all('p') if p.string and p.string.endswith(suffix)]
+        labels = [value[:-len(suffix)].lower().replace("-", "_").replace(" ", "_") for value in tag_strings]
         if not labels:
             raise UserWarning("Page was parsed, but no currently used labels found")
         print(f"Current labels are: \n{', '.join(labels)}")
         return labels
 
-    def get_attachments(self, request_limit: dict = {"limit": 50}) -> List[dict]:
+    def get_attachments(self, request_limit: dict = {"limit": 200}) -> List[dict]:
         """
-        Get all page attachments. request_limit used for pagination in requests
-        :param request_limit: {"limit": int}
+        Get all page attachments together with their labels. request_limit used for pagination in requests
+        :param request_limit: {"limit": int}, confluence allows up to 200
         """
         response = self._get_request(
             endpoint=f"content/{self.page_id}/child/attachment",
-            params=request_limit
+            params={**request_limit, "expand": "metadata.labels"}
         )
 
         data = response.json()
@@ -345,7 +528,7 @@ class Confluence(Request):
         next_url = data.get("_links").get("next")
         while next_url:
             response = self._get_request(
-                endpoint=next_url.lstrip("/rest/api/")
+                endpoint=next_url.removeprefix("/rest/api/")
             )
             data = response.json()
             attachments.extend(data.get("results"))
@@ -359,9 +542,13 @@ class Confluence(Request):
         :param lablels: list of labes
         :return: list of attachments with requested labels
         """
-        labeled_attachments = list(filter(
-            lambda attachment: set(labels).issubset(self.parse_attachment_labels(attachment)), self.attachments
-        ))
+        if not labels:
+            return list(self.attachments)
+        first, *rest = [self._attachments_by_label.get(label, {}) for label in labels]
+        labeled_attachments = [
+            attachment for attachment_id, attachment in first.items()
+            if all(attachment_id in attachments for attachments in rest)
+        ]
         return labeled_attachments
 
     def search_attachment_by_name(self, name: str) -> dict:
@@ -370,13 +557,7 @@ class Confluence(Request):
         :param name: attachment name
         :return: attachment dict
         """
-        attachments = list(filter(
-            lambda attachment: name == attachment.get("title"), self.attachments
-        ))
-        if attachments:
-            return attachments[0]
-        else:
-            return None
+        return self._by_title.get(name)
 
     def parse_attachment_labels(self, attachment: dict) -> List[str]:
         """
@@ -395,6 +576,14 @@ class Confluence(Request):
         Get list of attachment names which are labeled as "latest"
         return: List["attachment_name"]
         """
+        return self._latest_labeled_attachments
+
+    @functools.cached_property
+    def _latest_labeled_attachments(self) -> List[str]:
+        """
+        Cached result for get_latest_labeled_attachments,
+        reset by _update_attachment_labels
+        """
         labels = self.current_labels
         latest_attachements = []
         for label in labels:
@@ -403,10 +592,7 @@ class Confluence(Request):
 
     def file_exists(self, file_name: str) -> bool:
         "Check if file exists in confluence"
-        if file_name in self.attachment_titles:
-            return True
-        else:
-            return False
+        return file_name in self._by_title
 
     def date_is_newer(self, to_be_uploaded: str, existing: str) -> bool:
         """
@@ -424,46 +610,56 @@ class Confluence(Request):
         else:
             return False
 
-    def file_eligible_for_upload(self, file_name: str) -> bool:
+    def file_eligible_for_upload(self, file_name: str) -> Tuple[bool, Optional[str]]:
         """
         Check if file is eligible for uploading
         - file name match pattern
         - file is not already uploaded
         - already existing version is older
         :param file_name: name of the file to upload
+        :return: (eligible, predecessor file name or None) - predecessor is passed to send_and_label_attachment
         """
         if not parse_testfile_name(file_name):
             print("File name doesn't match the pattern")
-            return False
+            return False, None
         if self.file_exists(file_name):
             print("File exists")
-            return False
+            return False, None
         predecessor_file = self.get_attachment_predecessor(file_name)
         if not predecessor_file:
             print("No predecessor")
-            return True
+            return True, predecessor_file
         if self.date_is_newer(file_name, predecessor_file):
             print("File is newer")
-            return True
+            return True, predecessor_file
         else:
             print("Uploaded file is newer")
-            return False
+            return False, predecessor_file
+
+    def get_search_prefix(self, file_name: str) -> str:
+        """
+        Get file name prefix shared by all versions of the file
+        "NTG7_Module_Test_RSU_E444.303_2023-03-29_v700.208.1.xlsx" will result -> "NTG7_Module_Test_RSU"
+        :param file_name: name of the file
+        :return: search prefix
+        """
+        parsed_file = parse_testfile_name(file_name)
+        star = f'{parsed_file["star"]}_' if parsed_file["star"] else ''
+        module = parsed_file["module"].upper()
+        return f"NTG7_Module_Test_{star}{module}"
 
-    def get_attachment_predecessor(self, file_name: str) -> str:
+    def get_attachment_predecessor(self, file_name: str) -> Optional[str]:
         """
         Find already uploaded version of the fle marked as "latest"
         For example
         New file is "NTG7_Module_Test_RSU_E444.303_2023-03-29_v700.208.1.xlsx"
         It will look for file which starts with "NTG7_Module_Test_RSU" and marked as "latest"
         :param file_name: name of the file to upload
-        :return: predecessor file name
+        :return: predecessor file name or None
         """
-        parsed_file = parse_testfile_name(file_name)
-        star = f'{parsed_file["star"]}_' if parsed_file["star"] else ''
-        module = parsed_file["module"].upper()
-        search_prefix = f"NTG7_Module_Test_{star}{module}"
+        search_prefix = self.get_search_prefix(file_name)
 
-        predecessor_file = ""
+        predecessor_file = None
         for latest_attachment in self.get_latest_labeled_attachments():
             if search_prefix in latest_attachment:
                 predecessor_file = latest_attachment
@@ -477,18 +673,28 @@ class Confluence(Request):
         """
         print("Sending file...")
         endpoint = f"content/{self.page_id}/child/attachment"
-        files = {'file': open(file, "rb")}
-        headers = {
-            'X-Atlassian-Token': 'no-check'
-        }
-        response = self._post_request(endpoint=endpoint, headers=headers, files=files)
+        with open(file, "rb") as file_content:
+            # Stream file from disk instead of building whole multipart body in memory
+            multipart = MultipartEncoder(fields={
+                'file': (file.name, file_content, "application/octet-stream")
+            })
+            headers = {
+                'X-Atlassian-Token': 'no-check',
+                'Content-Type': multipart.content_type
+            }
+            response = self._post_request(
+                endpoint=endpoint, headers=headers, data=multipart, session=self.upload_session
+            )
 
-        return response.json().get("results")[0].get("id")
+        attachment = response.json().get("results")[0]
+        self.attachments.append(attachment)
+        self._index_attachment(attachment, [])
+        return attachment.get("id")
 
     def add_label(self, attachment_id: str, label_list: List[str]) -> bool:
         """
         Add lable to attachment.
-        Retry 3 times if response.status_code = 500
+        Failed requests are retried by session adapter
         :param attachment_id: ID of attachment
         :param label_list: list of labels to be added
         :return: return True if successfull else False
@@ -504,17 +710,9 @@ class Confluence(Request):
                 "name": f"{label}"
             })
         response = self._post_request(endpoint=endpoint, headers=headers, data=json.dumps(body))
-        if response.status_code == 500:
-            retry = 0
-            while retry < 3:
-                time.sleep(3)
-                response = self._post_request(endpoint=endpoint, headers=headers, data=json.dumps(body))
-                if response.status_code == 500:
-                    retry += 1
-        if response.status_code == 200:
-            return True
-        else:
-            return False
+        if response.ok:
+            self._update_attachment_labels(attachment_id, added=label_list)
+        return response.ok
 
     def remove_label(self, attachment_id: str, label: str) -> None:
         """
@@ -527,16 +725,18 @@ class Confluence(Request):
         params = {
             "name": label
         }
-        self._delete_request(endpoint=endpoint, params=params)
+        response = self._delete_request(endpoint=endpoint, params=params)
+        if response.ok:
+            self._update_attachment_labels(attachment_id, removed=[label])
 
-    def send_and_label_attachment(self, file_name: str) -> None:
+    def send_and_label_attachment(self, file_name: str, predecessor_name: Optional[str]) -> None:
         """
         Upload attachment and add corresponding labels including "latest", and if successfull:
         if previous version of the file exists (predecessor), remove "latest" label from it
         :param file_name: name of the file to upload
+        :param predecessor_name: predecessor file name as returned by file_eligible_for_upload
         """
         file_path = Path(f"downloads/{file_name}")
-        predecessor_name = self.get_attachment_predecessor(file_name)
 
         attachment_id = self.add_page_attachment(file_path)
 
@@ -1,4 +1,5 @@
 from atlasian import Jira, Confluence
+import asyncio
 import json
 from pathlib import Path
 
@@ -29,16 +30,28 @@ with open("tokens.json", "r") as file:
     user_name = data['username']
 
 cert = prepare_cert()
-jira = Jira(jira_api_url, user_name, jira_token, cert)
-confluence = Confluence(confluence_page_id, confluence_api_url, user_name, confluence_token, cert)
+with Jira(jira_api_url, user_name, jira_token, cert) as jira, \
+        Confluence(confluence_page_id, confluence_api_url, user_name, confluence_token, cert) as confluence:
+    resent_issues = jira.get_recently_updated_release_tasks()
+    # Eligibility is checked before any upload, so only the newest file per prefix is kept
+    # to avoid labeling several versions of the same file as "latest"
+    eligible_attachments = {}
+    for issue in resent_issues:
+        for attachment in issue["attachments"]:
+            file_name = attachment['file_name']
+            print(f"Processing {file_name}")
+            eligible, predecessor = confluence.file_eligible_for_upload(file_name)
+            if eligible:
+                prefix = confluence.get_search_prefix(file_name)
+                selected = eligible_attachments.get(prefix)
+                if selected and not confluence.date_is_newer(file_name, selected['file_name']):
+                    print(f"Newer or same version is already going to be uploaded:\n{selected['file_name']}")
+                else:
+                    eligible_attachments[prefix] = {**attachment, "predecessor": predecessor}
+            else:
+                print("will not be uploaded")
+            print("*" * 40)
 
-resent_issues = jira.get_recently_updated_release_tasks()
-for issue in resent_issues:
-    for attachment in issue["attachments"]:
-        print(f"Processing {attachment['file_name']}")
-        if attachment and confluence.file_eligible_for_upload(attachment['file_name']):
-            jira.download_attachment(attachment["download_url"], attachment["file_name"])
-            confluence.send_and_label_attachment(attachment['file_name'])
-        else:
-            print("will not be uploaded")
-        print("*" * 40)
+    downloaded_attachments = asyncio.run(jira._download_all(list(eligible_attachments.values())))
+    for attachment in downloaded_attachments:
+        confluence.send_and_label_attachment(attachment['file_name'], attachment['predecessor'])